@@ -2,41 +2,166 @@ import streamlit as st
 import pandas as pd
 import io
 import csv
-import os
 import re
+import asyncio
+import os
 import zipfile
 import tempfile
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
 import base64
-from bs4 import BeautifulSoup
-from jinja2 import Template
+import mmap
+import multiprocessing
+import threading
+from collections import OrderedDict
+from selectolax.lexbor import LexborHTMLParser
+from jinja2 import Environment
 import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from packager import load_template_assets, build_base_zip, link_or_copy, init_worker, build_packages
 
 # ------------- KONFIGURACJA I INICJALIZACJA --------------------
 OUTPUT_FOLDER = 'generated_mails'
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# Folder tymczasowy na rozpakowany szablon
-TEMPLATE_TEMP_FOLDER = tempfile.mkdtemp(prefix="template_")
+# Maksymalna liczba jednocześnie scrapowanych stron
+SCRAP_CONCURRENCY = 20
+
+# Maksymalna liczba równolegle pobieranych obrazów
+DOWNLOAD_WORKERS = 16
+
+# Sposób uruchamiania procesów budujących paczki. fork z wielowątkowego serwera Streamlit może
+# skopiować blokadę zajętą przez wątek innej sesji i zakleszczyć proces roboczy, więc tam, gdzie
+# to możliwe, używamy forkserver (w pozostałych systemach – spawn)
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# Prefiksy wartości kolumn obrazów, które pobieramy z internetu
+HTTP_PREFIXES = ("http://", "https://")
+
+# Limity czasu żądań HTTP w sekundach: (nawiązanie połączenia, odczyt odpowiedzi)
+SCRAP_TIMEOUT = (3.05, 8)
+
+# Domyślny łączny limit czasu scrapowania jednego URL-a (s); można go zmienić w panelu bocznym
+SCRAP_TOTAL_TIMEOUT = 10
+
+# Rozmiar fragmentu przy strumieniowym zapisie pobieranych obrazów
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Czas życia (s) zapamiętanych wyników scrapowania i pobranych obrazów
+CACHE_TTL = 3600
+
+# Maksymalna liczba wpisów w każdej z tych pamięci podręcznych
+CACHE_MAXSIZE = 2048
+
+# Nagłówek User-Agent przeglądarki – część serwisów odrzuca domyślny nagłówek bibliotek HTTP
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:128.0) Gecko/20100101 Firefox/128.0"
 
 st.set_page_config(page_title="Generator Paczek Mailingowych - Scrap + Template", layout="wide")
 
+@st.cache_resource(show_spinner=False)
+def create_http_session():
+    """Tworzy współdzieloną sesję HTTP z pulą połączeń i ponawianiem żądań (429/5xx)."""
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+# Sesja HTTP współdzielona między przebiegami skryptu (keep-alive dla wielu obrazów z tego samego hosta)
+SESSION = create_http_session()
+
+@st.cache_resource(show_spinner=False)
+def create_workspace():
+    """Tworzy folder wyjściowy – raz na proces serwera, a nie przy każdym przebiegu skryptu."""
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+create_workspace()
+
+def session_template_folder():
+    """
+    Zwraca folder tymczasowy na rozpakowany szablon, tworzony raz na sesję użytkownika
+    (cache_resource jest wspólny dla wszystkich sesji, więc nie może przechowywać szablonu).
+    Folder jest usuwany po zakończeniu sesji lub przy zamknięciu aplikacji.
+    """
+    if "template_dir" not in st.session_state:
+        st.session_state.template_dir = tempfile.TemporaryDirectory(prefix="template_", ignore_cleanup_errors=True)
+    return st.session_state.template_dir.name
+
+class LRUCache:
+    """
+    Słownik o ograniczonym rozmiarze: po przekroczeniu maxsize usuwa najdawniej używany wpis.
+    Korzystają z niego wątki wszystkich sesji, więc operacje są chronione blokadą.
+    """
+
+    def __init__(self, maxsize=CACHE_MAXSIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+@st.cache_resource(show_spinner=False, ttl=CACHE_TTL)
+def scrap_cache():
+    """Zwraca pamięć URL -> wynik scrapowania, współdzieloną między przebiegami skryptu."""
+    return LRUCache()
+
+@st.cache_resource(show_spinner=False, ttl=CACHE_TTL)
+def image_cache():
+    """
+    Zwraca pamięć ścieżka pobranego obrazu -> URL, z którego pochodzi jego zawartość, współdzieloną
+    między przebiegami skryptu. Kluczem jest ścieżka, bo obraz z innego URL-a o tej samej nazwie pliku
+    zastępuje plik – jego wpis zastępuje wtedy też poprzedni.
+    """
+    return LRUCache()
+
 # Globalna zmienna przechowująca kod szablonu
 global_template_code = None
 
 # ------------- FUNKCJE POMOCNICZE --------------------
 
-def extract_template_zip(uploaded_zip):
-    """Rozpakowuje przesłany plik ZIP do folderu tymczasowego i zwraca ścieżkę do pliku index.html."""
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        with zipfile.ZipFile(uploaded_zip, "r") as zip_ref:
-            zip_ref.extractall(TEMPLATE_TEMP_FOLDER)
-    index_path = os.path.join(TEMPLATE_TEMP_FOLDER, "index.html")
+def extract_template_zip(uploaded_zip, template_folder):
+    """Rozpakowuje przesłany plik ZIP do folderu template_folder i zwraca ścieżkę do pliku index.html."""
+    # Folder jest współdzielony między przebiegami skryptu, więc usuwamy pozostałości poprzedniego szablonu.
+    # Pliki tworzymy od nowa (a nie nadpisujemy), aby nie zmieniać zasobów dowiązanych w gotowych paczkach.
+    shutil.rmtree(template_folder, ignore_errors=True)
+    with zipfile.ZipFile(uploaded_zip, "r") as zip_ref:
+        zip_ref.extractall(template_folder)
+    index_path = os.path.join(template_folder, "index.html")
     if not os.path.exists(index_path):
         st.error("W archiwum ZIP nie znaleziono pliku index.html!")
         return None
     return index_path
 
+# Środowisko Jinja dla szablonów maili (bez sprawdzania zmian – szablon jest przekazywany jako tekst)
+TEMPLATE_ENV = Environment(auto_reload=False, cache_size=400)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def compile_template(template_code):
+    """Kompiluje kod szablonu Jinja; wynik jest współdzielony między przebiegami (podgląd, generowanie)."""
+    return TEMPLATE_ENV.from_string(template_code)
+
 def load_template_from_file(template_path):
     """Wczytuje zawartość pliku szablonu."""
     try:
@@ -46,91 +171,211 @@ def load_template_from_file(template_path):
         st.error(f"Błąd podczas wczytywania szablonu: {e}")
         return None
 
-def download_image(image_url, dest_folder):
-    """Pobiera obraz z URL i zapisuje go w folderze dest_folder.
-    Jeśli image_url zaczyna się od 'data:', zwraca go bez zmian.
+def image_file_path(image_url, dest_folder):
+    """Zwraca ścieżkę, pod którą obraz z image_url jest zapisywany w folderze dest_folder."""
+    return os.path.join(dest_folder, os.path.basename(image_url.split('?')[0]))
+
+def fetch_image(image_url, dest_folder, session=SESSION):
+    """Pobiera obraz z URL do folderu dest_folder i zwraca ścieżkę do pliku.
+    Błędy są zgłaszane wyjątkiem, więc funkcję można bezpiecznie wywoływać z wątków roboczych.
     """
-    if not image_url:
-        return None
-    # Jeżeli już jest Data URI, nie próbuj pobierać ponownie
-    if image_url.startswith("data:"):
-        return image_url
-    try:
-        response = requests.get(image_url, timeout=10)
+    local_path = image_file_path(image_url, dest_folder)
+    # Plik podmieniamy zamiast nadpisywać, bo istniejący local_path może być dowiązaniem
+    # współdzielonym z innymi paczkami. Plik tymczasowy tworzymy przez open(), aby uprawnienia
+    # wynikały z umask, jak przy zwykłym zapisie (NamedTemporaryFile tworzy pliki 0600).
+    tmp_path = f"{local_path}.{uuid.uuid4().hex}.part"
+    # Zapis strumieniowy – w pamięci trzymamy tylko bieżący fragment, a nie cały obraz
+    with session.get(image_url, timeout=SCRAP_TIMEOUT, stream=True) as response:
         response.raise_for_status()
-        filename = os.path.basename(image_url.split('?')[0])
-        local_path = os.path.join(dest_folder, filename)
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
+        try:
+            with open(tmp_path, 'xb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return local_path
+
+def cached_image_path(image_url, dest_folder):
+    """
+    Zwraca ścieżkę obrazu pobranego wcześniej z image_url do dest_folder, o ile plik nadal istnieje
+    i nie został w międzyczasie zastąpiony obrazem z innego URL-a.
+    """
+    local_path = image_file_path(image_url, dest_folder)
+    if image_cache().get(local_path) == image_url and os.path.exists(local_path):
         return local_path
-    except Exception as e:
-        st.error(f"Błąd pobierania obrazu z {image_url}: {e}")
-        return None
+    return None
 
+def fetch_image_bytes(image_url, session=SESSION):
+    """Pobiera obraz z URL do pamięci i zwraca parę (zawartość, typ MIME).
+    Błędy są zgłaszane wyjątkiem, więc funkcję można bezpiecznie wywoływać z wątków roboczych.
+    """
+    response = session.get(image_url, timeout=SCRAP_TIMEOUT)
+    response.raise_for_status()
+    mime = response.headers.get("Content-Type", "").split(";")[0].strip()
+    if not mime.startswith("image/"):
+        mime = image_mime_type(image_url.split('?')[0])
+    return response.content, mime
+
+
+# Typy MIME obrazów według rozszerzenia pliku
+IMAGE_MIME_TYPES = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+}
+
+def image_mime_type(image_path):
+    """Zwraca typ MIME obrazu na podstawie rozszerzenia pliku."""
+    # Rozszerzenie (bez kropki) bierzemy z samej nazwy pliku – kropki w domenie lub katalogach nie mają znaczenia
+    name = os.path.basename(image_path)
+    ext = name.rpartition('.')[2].lower() if '.' in name else ""
+    return IMAGE_MIME_TYPES.get(ext, f"image/{ext}")
 
 def embed_image_as_data_uri(image_path):
     """Odczytuje obraz z podanej ścieżki i zwraca data URI (base64)."""
     if not os.path.exists(image_path):
         return ""
-    ext = os.path.splitext(image_path)[1][1:].lower()  # rozszerzenie bez kropki
-    if ext == "svg":
-        mime = "image/svg+xml"
-    else:
-        mime = f"image/{ext}"
+    mime = image_mime_type(image_path)
     try:
         with open(image_path, "rb") as f:
-            data = f.read()
-        b64 = base64.b64encode(data).decode()
+            # Plik mapujemy do pamięci – base64 koduje go bez wczytywania kopii do obiektu bytes
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    b64 = base64.b64encode(data).decode("ascii")
+            else:
+                b64 = ""
         return f"data:{mime};base64,{b64}"
     except Exception as e:
         st.error(f"Błąd przy konwersji obrazu do data URI: {e}")
         return ""
 
-def zip_output_for_folder(folder, package_identifier):
-    """Zipuje folder, nadając archiwum nazwę <package_identifier>.zip"""
-    zip_filename = f"{package_identifier}"
-    shutil.make_archive(zip_filename, 'zip', folder)
-    return f"{zip_filename}.zip"
+async def fetch_page(session, semaphore, url):
+    """
+    Pobiera treść strony przez wspólną sesję aiohttp; semaphore ogranicza liczbę równoległych żądań.
+    Zwraca parę (zawartość, kodowanie z nagłówka Content-Type lub None).
+    """
+    async with semaphore, session.get(url) as r:
+        r.raise_for_status()
+        return await r.read(), r.charset
 
-def scrap_page(url):
+
+def parse_page(content, charset=None):
     """
-    Scrapuje stronę podaną przez URL i zwraca słownik z kluczami: title, img, lead.
+    Parsuje pobrany HTML i zwraca słownik z kluczami: title, img, lead.
+    charset to kodowanie z nagłówka HTTP; bez niego kodowanie jest wykrywane z treści (<meta charset>).
     title: tekst pierwszego tagu H1.
     img: adres URL obrazu z selektora 'div.entry-image > img'.
     lead: tekst z 'div.entry-lead'. Jeśli nie znaleziono tego elementu,
           próbuje odszukać 'div.article__content' i zwraca pierwsze 150 znaków tekstu.
     """
+    # Lexbor domyślnie traktuje bajty jako UTF-8, więc strony w innych kodowaniach (np. ISO-8859-2)
+    # dekodujemy według nagłówka HTTP, a gdy go brak – zlecamy wykrycie kodowania parserowi
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.content, 'html.parser')
-        
-        # Tytuł: pierwszy tag H1
-        h1 = soup.find('h1')
-        title = h1.get_text(strip=True) if h1 else ""
-        
-        # Obraz: selektor "div.entry-image > img"
-        img_tag = soup.select_one("div.entry-image > img")
-        img = img_tag.get("src", "") if img_tag else ""
-        
-        # Lead: próba pobrania z div.entry-lead
-        lead_tag = soup.select_one("div.entry-lead")
-        if lead_tag:
-            lead_text = lead_tag.get_text(strip=True)
-        else:
-            # Jeśli nie znaleziono, próbujemy z div.article__content – pobieramy czysty tekst
-            article_tag = soup.select_one("div.article__content")
-            lead_text = article_tag.get_text(separator=" ", strip=True) if article_tag else ""
-        
-        # Ograniczenie tekstu do pierwszych 150 znaków
-        lead = lead_text[:150]
-        
-        return {"title": title, "img": img, "lead": lead}
+        html = content.decode(charset, errors="replace") if charset else None
+    except LookupError:  # nieznana nazwa kodowania w nagłówku
+        html = None
+    tree = LexborHTMLParser(html) if html is not None else LexborHTMLParser(content, encoding=True)
+    
+    # Tytuł: pierwszy tag H1
+    h1 = tree.css_first("h1")
+    title = h1.text(strip=True) if h1 else ""
+    
+    # Obraz: selektor "div.entry-image > img"
+    img_tag = tree.css_first("div.entry-image > img")
+    img = (img_tag.attributes.get("src") or "") if img_tag else ""
+    
+    # Lead: próba pobrania z div.entry-lead
+    lead_tag = tree.css_first("div.entry-lead")
+    if lead_tag:
+        lead_text = lead_tag.text(strip=True)
+    else:
+        # Jeśli nie znaleziono, próbujemy z div.article__content – pobieramy czysty tekst
+        article_tag = tree.css_first("div.article__content")
+        lead_text = article_tag.text(separator=" ", strip=True) if article_tag else ""
+    
+    # Ograniczenie tekstu do pierwszych 150 znaków
+    lead = lead_text[:150]
+    
+    return {"title": title, "img": img, "lead": lead}
+
+
+async def scrap_page(session, semaphore, url, cache):
+    """
+    Scrapuje stronę podaną przez URL i zwraca słownik z kluczami: title, img, lead.
+    Parsowanie HTML odbywa się w osobnym wątku, aby nie blokować pętli zdarzeń
+    w trakcie pobierania pozostałych stron. Udane wyniki są zapamiętywane w cache,
+    więc ponowne przetworzenie tych samych URL-i nie wymaga pobierania stron.
+    """
+    cached = cache.get(url)
+    if cached is not None:
+        return cached
+    try:
+        content, charset = await fetch_page(session, semaphore, url)
+        data = await asyncio.to_thread(parse_page, content, charset)
+        cache[url] = data
+        return data
     except Exception as e:
         st.error(f"Błąd scrapowania {url}: {e}")
         return {"title": "", "img": "", "lead": ""}
 
 
+async def scrap_csv_rows(header, reader, timeout=SCRAP_TOTAL_TIMEOUT):
+    """
+    Czyta kolejne wiersze CSV (listy wartości) i od razu zleca scrapowanie ich url1/url2
+    (maksymalnie SCRAP_CONCURRENCY stron naraz), więc pobieranie rusza już w trakcie czytania pliku.
+    timeout to łączny limit czasu (s) na jeden URL; połączenie i odczyt ograniczają dodatkowo SCRAP_TIMEOUT.
+    Zwraca listę słowników: kolumny z CSV oraz title1, img1, lead1, title2, img2, lead2.
+    """
+    url_columns = [(offset, header.index(f"url{suffix}")) for offset, suffix in ((0, "1"), (3, "2")) if f"url{suffix}" in header]
+    cache = scrap_cache()
+    semaphore = asyncio.Semaphore(SCRAP_CONCURRENCY)
+    client_timeout = aiohttp.ClientTimeout(total=timeout, connect=SCRAP_TIMEOUT[0], sock_read=SCRAP_TIMEOUT[1])
+    rows = []
+    scraped = []
+    # URL -> zadanie scrapowania; powtarzające się adresy scrapujemy tylko raz
+    tasks = {}
+    # URL -> lista (indeks wiersza, przesunięcie kolumn), do których trafia wynik
+    targets = {}
+    async with aiohttp.ClientSession(timeout=client_timeout, headers={"User-Agent": USER_AGENT}) as session:
+
+        async def scrap_job(url):
+            return url, await scrap_page(session, semaphore, url, cache)
+
+        for values in reader:
+            # Puste linie pomijamy, tak jak csv.DictReader
+            if not values:
+                continue
+            # Brakujące kolumny uzupełniamy wartością None (jak csv.DictReader). Nadmiarowe wartości
+            # celowo pomijamy – csv.DictReader zbierał je w liście pod kluczem None, którego nie da się
+            # użyć w szablonie ani sensownie pokazać w tabeli
+            values = values[:len(header)] + [None] * (len(header) - len(values))
+            for offset, column_index in url_columns:
+                url = values[column_index]
+                if url:
+                    if url not in tasks:
+                        tasks[url] = asyncio.create_task(scrap_job(url))
+                    targets.setdefault(url, []).append((len(rows), offset))
+            rows.append(values)
+            scraped.append([""] * 6)
+            # Oddajemy sterowanie pętli, aby zlecone zadania mogły wysłać żądania przed kolejnym wierszem
+            await asyncio.sleep(0)
+
+        for task in asyncio.as_completed(tasks.values()):
+            url, data = await task
+            for row_index, offset in targets[url]:
+                scraped[row_index][offset:offset + 3] = (data["title"], data["img"], data["lead"])
+
+    # Słowniki budujemy dopiero na końcu, z gotowych list wartości
+    fieldnames = header + ["title1", "img1", "lead1", "title2", "img2", "lead2"]
+    return [dict(zip(fieldnames, values + extra)) for values, extra in zip(rows, scraped)]
+
+
 def save_data_uri_as_file(data_uri, dest_folder, default_filename="image"):
     """
     Jeśli data_uri zaczyna się od 'data:', dekoduje zawartość base64 i zapisuje ją jako plik.
@@ -148,64 +393,50 @@ def save_data_uri_as_file(data_uri, dest_folder, default_filename="image"):
         ext = mime_type.split("/")[1]       # "webp"
         filename = f"{default_filename}.{ext}"
         dest_path = os.path.join(dest_folder, filename)
+        data = base64.b64decode(b64data)
+        # Istniejący plik usuwamy, aby nie nadpisywać zawartości współdzielonej przez dowiązanie
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
         with open(dest_path, "wb") as f:
-            f.write(base64.b64decode(b64data))
+            f.write(data)
         return dest_path
     except Exception as e:
         st.error(f"Błąd zapisu data URI do pliku: {e}")
         return None
 
 
-def process_scrape_csv(file_bytes):
+def process_scrape_csv(file_bytes, timeout=SCRAP_TOTAL_TIMEOUT):
     """
     Scrapuje dane dla każdego wiersza CSV.
     CSV powinien zawierać kolumny: ID, url1, url2.
     Dla url1 i url2 scrapuje tytuł (H1), adres URL obrazu (div.entry-image > img) oraz lead (div.entry-lead)
     i dodaje do danych nowe kolumny:
       title1, img1, lead1, title2, img2, lead2.
+    timeout to łączny limit czasu (s) scrapowania jednego URL-a.
     Zwraca listę słowników (każdy odpowiada wierszowi).
     """
     file_io = io.StringIO(file_bytes.decode('utf-8-sig'))
-    reader = list(csv.DictReader(file_io, delimiter=';'))
-    if not reader:
+    reader = csv.reader(file_io, delimiter=';')
+    header = next(reader, None)
+    rows = asyncio.run(scrap_csv_rows(header, reader, timeout)) if header else []
+    if not rows:
         st.error("Brak danych w CSV.")
         return []
-    for row in reader:
-        # Scrapowanie dla url1
-        if "url1" in row and row["url1"]:
-            data1 = scrap_page(row["url1"])
-            row["url1"] = row["url1"]
-            row["title1"] = data1["title"]
-            row["img1"] = data1["img"]
-            row["lead1"] = data1["lead"]
-        else:
-            row["url1"] = row["url1"]
-            row["title1"] = ""
-            row["img1"] = ""
-            row["lead1"] = ""
-        # Scrapowanie dla url2
-        if "url2" in row and row["url2"]:
-            data2 = scrap_page(row["url2"])
-            row["url2"] = row["url2"]
-            row["title2"] = data2["title"]
-            row["img2"] = data2["img"]
-            row["lead2"] = data2["lead"]
-        else:
-            row["url2"] = row["url2"]
-            row["title2"] = ""
-            row["img2"] = ""
-            row["lead2"] = ""
-    return reader
+    return rows
 
-def process_csv(data_rows, template_code, naming_variable, dynamic_image_columns=None):
+def process_csv(data_rows, template_code, template_folder, naming_variable, dynamic_image_columns=None):
     """
     Generuje paczki na podstawie przetworzonych danych (lista słowników).
+    Zasoby szablonu (grafiki, style) pochodzą z folderu template_folder.
     Jeśli naming_variable jest podana, używa jej wartości do nazwy paczki, w przeciwnym razie numeruje paczki.
     Jeśli dynamic_image_columns jest podana, dla każdej z nich pobiera obraz i zastępuje wartość nazwą pliku.
     Zwraca listę ścieżek do wygenerowanych ZIP-ów.
     """
     zip_files = []
-    template_obj = Template(template_code)
+    # Zasoby szablonu wczytujemy i kompresujemy raz na całe generowanie, a nie osobno dla każdej paczki
+    template_assets = load_template_assets(template_folder)
+    base_zip_bytes = build_base_zip(template_assets)
+    packages = []
     for row_index, row in enumerate(data_rows, start=1):
         if naming_variable and naming_variable in row and row[naming_variable]:
             package_identifier = row[naming_variable]
@@ -214,74 +445,139 @@ def process_csv(data_rows, template_code, naming_variable, dynamic_image_columns
             
         package_folder = os.path.join(OUTPUT_FOLDER, f"{package_identifier}")
         os.makedirs(package_folder, exist_ok=True)
-        
-        # Przetwarzanie każdej wybranej kolumny z dynamicznym obrazem
-        if dynamic_image_columns:
-            for col in dynamic_image_columns:
-                if col in row and row[col]:
-                    # Jeśli wartość zaczyna się od "http", pobieramy obraz z internetu.
-                    if row[col].startswith("http"):
-                        image_path = download_image(row[col], package_folder)
-                        if image_path:
-                            row[col] = os.path.basename(image_path)
-                        else:
-                            row[col] = row[col]
-                    # Jeśli wartość zaczyna się od "data:", zapisujemy ją do pliku.
-                    elif row[col].startswith("data:"):
-                        image_path = save_data_uri_as_file(row[col], package_folder, default_filename=col)
-                        if image_path:
-                            row[col] = os.path.basename(image_path)
-                        else:
-                            row[col] = row[col]
-                    else:
-                        row[col] = row[col]
-
-
-        try:
-            rendered_html = template_obj.render(**row)
-        except Exception as e:
-            st.error(f"Błąd renderowania (pakiet {package_identifier}): {e}")
-            continue
-
-        try:
-            shutil.copytree(TEMPLATE_TEMP_FOLDER, package_folder, dirs_exist_ok=True)
-        except Exception as e:
-            st.error(f"Błąd kopiowania zasobów szablonu dla paczki {package_identifier}: {e}")
-            continue
-
-        output_html_path = os.path.join(package_folder, "index.html")
-        try:
-            with open(output_html_path, 'w', encoding='utf-8') as f:
-                f.write(rendered_html)
-        except Exception as e:
-            st.error(f"Błąd zapisu HTML dla paczki {package_identifier}: {e}")
-            continue
+        packages.append((row, package_identifier, package_folder))
 
-        st.info(f"Wygenerowano paczkę: {package_identifier}")
-        zip_file = zip_output_for_folder(package_folder, package_identifier)
-        zip_files.append(zip_file)
+    # Obrazy z internetu pobieramy równolegle dla wszystkich paczek naraz
+    # (obrazy pobrane już wcześniej do tego samego folderu bierzemy z cache).
+    # Każdy unikalny URL pobieramy raz – do folderu pierwszej paczki, która go potrzebuje –
+    # a do pozostałych paczek plik jest dowiązywany.
+    if dynamic_image_columns:
+        downloaded = image_cache()
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = {}
+            # URL -> lista (wiersz, kolumna, folder paczki), które potrzebują tego obrazu
+            targets = {}
+            for row, _, package_folder in packages:
+                for col in dynamic_image_columns:
+                    if (row.get(col) or "").startswith(HTTP_PREFIXES):
+                        cached_path = cached_image_path(row[col], package_folder)
+                        if cached_path:
+                            row[col] = os.path.basename(cached_path)
+                            continue
+                        if row[col] not in futures:
+                            futures[row[col]] = executor.submit(fetch_image, row[col], package_folder)
+                        targets.setdefault(row[col], []).append((row, col, package_folder))
+            for url, future in futures.items():
+                try:
+                    image_path = future.result()
+                except Exception as e:
+                    st.error(f"Błąd pobierania obrazu z {url}: {e}")
+                    continue
+                for row, col, package_folder in targets[url]:
+                    local_path = os.path.join(package_folder, os.path.basename(image_path))
+                    try:
+                        if local_path != image_path:
+                            link_or_copy(image_path, local_path)
+                    except OSError as e:
+                        st.error(f"Błąd kopiowania obrazu {url} do paczki: {e}")
+                        continue
+                    downloaded[local_path] = url
+                    row[col] = os.path.basename(local_path)
+
+    jobs = []
+    for row, package_identifier, package_folder in packages:
+        image_paths = []
+        for col in dynamic_image_columns or ():
+            value = row.get(col) or ""
+            # Wartości "data:" zapisujemy do plików w folderze paczki
+            if value.startswith("data:"):
+                image_path = save_data_uri_as_file(value, package_folder, default_filename=col)
+                if image_path:
+                    # Plik mógł zastąpić wcześniej pobrany obraz o tej samej nazwie
+                    image_cache().pop(image_path)
+                    value = row[col] = os.path.basename(image_path)
+            # Do archiwum dopisujemy tylko obrazy, które faktycznie trafiły do folderu paczki
+            if value and os.path.isfile(os.path.join(package_folder, value)):
+                image_paths.append(os.path.join(package_folder, value))
+        jobs.append((row, package_identifier, package_folder, image_paths))
+
+    if not jobs:
+        return zip_files
+
+    # Szablon sprawdzamy przed uruchomieniem procesów – błąd składni w init_worker
+    # przerwałby każdy proces roboczy bez czytelnego komunikatu
+    try:
+        compile_template(template_code)
+    except Exception as e:
+        st.error(f"Błąd kompilacji szablonu: {e}")
+        return zip_files
+
+    # Wiersze o tym samym identyfikatorze zapisują ten sam folder i ZIP, więc budujemy je kolejno
+    # w jednym zadaniu; różne paczki mogą powstawać równolegle
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job[2], []).append(job)
+
+    # Renderowanie i kompresja są operacjami CPU, więc paczki budujemy w osobnych procesach.
+    # Szablon i zasoby trafiają do procesów raz, przez initializer.
+    max_workers = min(os.cpu_count() or 1, len(groups))
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=MP_CONTEXT,
+        initializer=init_worker,
+        initargs=(template_code, template_assets, template_folder, base_zip_bytes),
+    ) as executor:
+        futures = [(group, executor.submit(build_packages, group)) for group in groups.values()]
+        for group, future in futures:
+            try:
+                results = future.result()
+            except Exception as e:
+                st.error(str(e))
+                continue
+            for job, (zip_file, error) in zip(group, results):
+                if error:
+                    st.error(error)
+                    continue
+                zip_files.append(zip_file)
+                st.info(f"Wygenerowano paczkę: {job[1]}")
     return zip_files
 
+# Deklaracja doctype na początku dokumentu HTML
+DOCTYPE_RE = re.compile(r"\s*<!DOCTYPE[^>]*>", re.IGNORECASE)
+
 def inline_base_images(html_text, base_folder):
     """
-    Szuka w html_text wszystkich atrybutów src, które nie zaczynają się od "data:".
-    Dla znalezionych ścieżek traktuje je jako relatywne względem base_folder i
-    jeśli odpowiadają rzeczywistym plikom, konwertuje je na Data URI.
+    Parsuje html_text i dla każdego tagu <img>, którego src nie zaczyna się od "data:",
+    traktuje ścieżkę jako relatywną względem base_folder; jeśli odpowiada ona
+    rzeczywistemu plikowi, podmienia src na Data URI. Zwraca zserializowany HTML,
+    a gdy żaden src nie został podmieniony – html_text bez zmian.
     """
-    def replace_src(match):
-        src = match.group(1)
+    # Data URI już zakodowanych plików – ten sam obraz (np. logo, odstępnik) kodujemy tylko raz
+    data_uris = {}
+    replaced = False
+    tree = LexborHTMLParser(html_text)
+    for img in tree.css("img[src]"):
+        src = img.attributes.get("src")
         # Jeśli src już jest Data URI, nic nie zmieniamy
-        if src.startswith("data:"):
-            return match.group(0)
+        if not src or src.startswith("data:"):
+            continue
         # Tworzymy pełną ścieżkę do pliku
         file_path = os.path.join(base_folder, src)
-        if os.path.exists(file_path):
-            data_uri = embed_image_as_data_uri(file_path)
-            return match.group(0).replace(src, data_uri)
-        else:
-            return match.group(0)
-    pattern = re.compile(r'src=["\'](.*?)["\']')
-    return pattern.sub(replace_src, html_text)
+        if file_path not in data_uris:
+            data_uris[file_path] = embed_image_as_data_uri(file_path) if os.path.exists(file_path) else ""
+        if data_uris[file_path]:
+            img.attrs["src"] = data_uris[file_path]
+            replaced = True
+    # Serializacja drzewa zmienia znaczniki (np. dodaje <tbody>), więc stosujemy ją tylko wtedy, gdy trzeba
+    if not replaced:
+        return html_text
+    # Lexbor zapisuje każdy doctype jako <!DOCTYPE html>, co zmienia tryb renderowania (np. dla XHTML
+    # Transitional), więc przywracamy oryginalną deklarację
+    html = tree.html
+    original_doctype = DOCTYPE_RE.match(html_text)
+    if original_doctype:
+        html = DOCTYPE_RE.sub(lambda _: original_doctype.group(0).lstrip(), html, count=1)
+    return html
 
 def generate_preview(file_bytes, template_code, dynamic_image_columns=None):
     """
@@ -305,21 +601,25 @@ def generate_preview(file_bytes, template_code, dynamic_image_columns=None):
     preview_folder = os.path.join(OUTPUT_FOLDER, "preview")
     os.makedirs(preview_folder, exist_ok=True)
     
-    # Przetwarzanie dynamicznych kolumn obrazów
+    # Przetwarzanie dynamicznych kolumn obrazów: obrazy z internetu pobieramy równolegle
+    # do pamięci i od razu zamieniamy na Data URI. Data URI i pozostałe wartości zostawiamy bez zmian.
     if dynamic_image_columns:
-        for col in dynamic_image_columns:
-            if col in preview_row and preview_row[col]:
-                # Jeśli wartość zaczyna się od "http", pobieramy obraz i konwertujemy na Data URI.
-                if preview_row[col].startswith("http"):
-                    image_path = download_image(preview_row[col], preview_folder)
-                    embedded_image = embed_image_as_data_uri(image_path)
-                    preview_row[col] = embedded_image if embedded_image else preview_row[col]
-                # Jeśli już jest Data URI – pozostawiamy taką wartość.
-                elif preview_row[col].startswith("data:"):
-                    preview_row[col] = preview_row[col]
+        columns = [col for col in dynamic_image_columns if (preview_row.get(col) or "").startswith(HTTP_PREFIXES)]
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = {url: executor.submit(fetch_image_bytes, url) for url in {preview_row[col] for col in columns}}
+            data_uris = {}
+            for url, future in futures.items():
+                try:
+                    content, mime = future.result()
+                    data_uris[url] = f"data:{mime};base64,{base64.b64encode(content).decode('ascii')}"
+                except Exception as e:
+                    st.error(f"Błąd pobierania obrazu z {url}: {e}")
+        for col in columns:
+            if preview_row[col] in data_uris:
+                preview_row[col] = data_uris[preview_row[col]]
     
     try:
-        template_obj = Template(template_code)
+        template_obj = compile_template(template_code)
         preview_html = template_obj.render(**preview_row)
     except Exception as e:
         st.error(f"Błąd podczas generowania podglądu: {e}")
@@ -344,6 +644,8 @@ def copy_button_html(text_to_copy, button_text="Kopiuj"):
 
 st.title("Generator Paczek Mailingowych z Scrapowaniem Danych")
 
+scrap_timeout = st.sidebar.number_input("Limit czasu na URL (s)", value=SCRAP_TOTAL_TIMEOUT, min_value=1, max_value=60)
+
 st.header("1. Wgraj dane (CSV)")
 uploaded_csv = st.file_uploader("Wgraj plik CSV (kolumny: ID; url1; url2)", type=["csv"], key="csv_uploader")
 csv_columns = None
@@ -360,7 +662,7 @@ st.markdown("---")
 st.header("2. Przetwórz dane (Scrap)")
 if uploaded_csv:
     if st.button("Przetwórz dane"):
-        data_rows = process_scrape_csv(uploaded_csv.getvalue())
+        data_rows = process_scrape_csv(uploaded_csv.getvalue(), timeout=scrap_timeout)
         if data_rows:
             st.session_state.scraped_data = data_rows  # zapisz scrapowane dane
             df_scraped = pd.DataFrame(data_rows)
@@ -372,7 +674,13 @@ st.markdown("---")
 st.header("3. Wgraj szablon maila (ZIP)")
 uploaded_zip = st.file_uploader("Wgraj plik ZIP zawierający szablon (index.html + grafiki)", type=["zip"], key="zip_uploader")
 if uploaded_zip:
-    template_path = extract_template_zip(uploaded_zip)
+    template_folder = session_template_folder()
+    # Szablon rozpakowujemy tylko po wgraniu nowego pliku, a nie przy każdym przebiegu skryptu
+    if st.session_state.get("template_file_id") != uploaded_zip.file_id:
+        template_path = extract_template_zip(uploaded_zip, template_folder)
+        st.session_state.template_file_id = uploaded_zip.file_id if template_path else None
+    else:
+        template_path = os.path.join(template_folder, "index.html")
     if template_path:
         global_template_code = load_template_from_file(template_path)
         if global_template_code:
@@ -414,7 +722,7 @@ with col2:
                 data_rows = []
             if data_rows:
                 naming_var = None if naming_variable == "Domyślne numerowanie" else naming_variable
-                zip_files = process_csv(data_rows, global_template_code, naming_var, dynamic_image_columns=["img1", "img2"])
+                zip_files = process_csv(data_rows, global_template_code, session_template_folder(), naming_var, dynamic_image_columns=["img1", "img2"])
                 # Później przyciski do pobrania paczek...
                 if zip_files:
                     st.success("Generowanie paczek zakończone!")
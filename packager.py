@@ -0,0 +1,201 @@
+"""Budowanie paczek mailingowych (render szablonu, zasoby, ZIP) – bez zależności od Streamlit,
+dzięki czemu funkcje mogą działać w procesach roboczych ProcessPoolExecutor."""
+import io
+import os
+import shutil
+import stat
+import time
+import zipfile
+from jinja2 import Environment
+
+try:
+    from zlib_ng import zlib_ng
+except ImportError:  # zlib-ng jest opcjonalne – bez niego ZIP-y kompresuje standardowy zlib
+    zlib_ng = None
+
+
+class PackageError(Exception):
+    """Błąd budowania pojedynczej paczki; komunikat jest gotowy do wyświetlenia użytkownikowi."""
+
+
+# Poziom kompresji DEFLATE wpisów ZIP
+COMPRESS_LEVEL = 6
+
+# Formaty już skompresowane – DEFLATE nie zmniejszy ich rozmiaru, a jedynie zużyje CPU
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".zip", ".gz", ".mp3", ".mp4", ".webm", ".woff", ".woff2"}
+
+if zlib_ng is not None:
+    _stdlib_get_compressor = zipfile._get_compressor
+
+    def _get_compressor(compress_type, compresslevel=None):
+        """Zwraca kompresor DEFLATE z zlib-ng (ten sam format strumienia, szybsza kompresja); pozostałe metody bez zmian."""
+        if compress_type == zipfile.ZIP_DEFLATED:
+            level = zlib_ng.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+            return zlib_ng.compressobj(level, zlib_ng.DEFLATED, -15)
+        return _stdlib_get_compressor(compress_type, compresslevel)
+
+    # Podmiana na poziomie modułu zipfile obejmuje też procesy robocze, które importują ten moduł
+    zipfile._get_compressor = _get_compressor
+
+# Stan procesu roboczego ustawiany raz przez init_worker, aby duże dane (zasoby, archiwum bazowe)
+# nie były przesyłane osobno z każdym zadaniem
+_worker_state = {}
+
+
+def compress_type_for(name):
+    """Dobiera metodę kompresji wpisu ZIP: ZIP_STORED dla formatów już skompresowanych, w pozostałych przypadkach ZIP_DEFLATED."""
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def zip_entry(name, is_dir=False):
+    """
+    Tworzy ZipInfo wpisu zapisywanego z pamięci, z uprawnieniami jak przy pakowaniu plików z dysku:
+    0644 dla plików i 0755 dla katalogów (writestr z samą nazwą nadaje plikom 0600).
+    """
+    info = zipfile.ZipInfo(name + "/" if is_dir else name, date_time=time.localtime()[:6])
+    if is_dir:
+        info.external_attr = (stat.S_IFDIR | 0o755) << 16 | 0x10  # 0x10 – atrybut katalogu MS-DOS
+    else:
+        info.external_attr = (stat.S_IFREG | 0o644) << 16
+    return info
+
+def load_template_assets(template_folder):
+    """
+    Wczytuje zasoby szablonu (wszystkie pliki poza głównym index.html) do słownika
+    ścieżka względna -> zawartość, aby kolejne paczki nie musiały ponownie przeglądać folderu.
+    """
+    assets = {}
+    for root, _, files in os.walk(template_folder):
+        for name in files:
+            file_path = os.path.join(root, name)
+            rel_path = os.path.relpath(file_path, template_folder)
+            if rel_path == "index.html":
+                continue
+            with open(file_path, "rb") as f:
+                assets[rel_path] = f.read()
+    return assets
+
+def link_or_copy(src_path, dest_path):
+    """
+    Tworzy dest_path jako twarde dowiązanie do src_path; gdy to niemożliwe (np. inny system plików),
+    kopiuje plik. Istniejący dest_path jest wcześniej usuwany.
+    """
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copyfile(src_path, dest_path)
+
+def write_template_assets(assets, template_folder, dest_folder):
+    """
+    Odtwarza zasoby szablonu w folderze paczki. Pliki są dowiązywane twardo (os.link) do plików
+    w template_folder, a gdy to niemożliwe (np. inny system plików) – zapisywane z pamięci.
+    """
+    created_dirs = set()
+    for rel_path, data in assets.items():
+        dest_path = os.path.join(dest_folder, rel_path)
+        dest_dir = os.path.dirname(dest_path)
+        if dest_dir not in created_dirs:
+            os.makedirs(dest_dir, exist_ok=True)
+            created_dirs.add(dest_dir)
+        # Istniejący plik usuwamy, aby nie nadpisywać zawartości współdzielonej przez dowiązanie
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(os.path.join(template_folder, rel_path), dest_path)
+        except OSError:
+            with open(dest_path, "wb") as f:
+                f.write(data)
+
+def build_base_zip(assets):
+    """
+    Pakuje zasoby szablonu do archiwum ZIP w pamięci i zwraca jego bajty.
+    Archiwum jest kompresowane raz, a następnie stanowi podstawę ZIP-a każdej paczki.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+        # Katalogi zasobów zapisujemy jako osobne wpisy, tak jak robił to shutil.make_archive
+        dirs = set()
+        for rel_path in assets:
+            parent = os.path.dirname(rel_path)
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        for rel_dir in sorted(dirs):
+            zf.writestr(zip_entry(rel_dir, is_dir=True), b"", compress_type=zipfile.ZIP_STORED)
+        for rel_path, data in assets.items():
+            zf.writestr(zip_entry(rel_path), data, compress_type=compress_type_for(rel_path), compresslevel=COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+def zip_package(base_zip_bytes, package_identifier, rendered_html, image_paths):
+    """
+    Tworzy archiwum <package_identifier>.zip jako kopię archiwum bazowego szablonu,
+    do której dopisuje wyrenderowany index.html oraz obrazy paczki (image_paths).
+    Zwraca nazwę utworzonego pliku.
+    """
+    buffer = io.BytesIO(base_zip_bytes)
+    with zipfile.ZipFile(buffer, "a", compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+        zf.writestr(zip_entry("index.html"), rendered_html, compress_type=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL)
+        # Zasoby szablonu mają pierwszeństwo przed obrazami o tej samej nazwie (jak przy kopiowaniu folderu)
+        existing = set(zf.namelist())
+        for image_path in image_paths:
+            arcname = os.path.basename(image_path)
+            if arcname not in existing:
+                zf.write(image_path, arcname, compress_type=compress_type_for(arcname))
+                existing.add(arcname)
+    zip_filename = f"{package_identifier}.zip"
+    with open(zip_filename, "wb") as f:
+        f.write(buffer.getvalue())
+    return zip_filename
+
+
+def init_worker(template_code, template_assets, template_folder, base_zip_bytes):
+    """Inicjalizator procesu roboczego: kompiluje szablon i zapamiętuje wspólne dane wszystkich paczek."""
+    _worker_state["template"] = Environment(auto_reload=False).from_string(template_code)
+    _worker_state["assets"] = template_assets
+    _worker_state["template_folder"] = template_folder
+    _worker_state["base_zip"] = base_zip_bytes
+
+def build_package(row, package_identifier, package_folder, image_paths):
+    """
+    Buduje jedną paczkę: renderuje szablon dla wiersza, odtwarza zasoby szablonu w package_folder,
+    zapisuje index.html i tworzy archiwum ZIP. Wymaga wcześniejszego wywołania init_worker.
+    Zwraca nazwę pliku ZIP; błędy zgłasza wyjątkiem PackageError.
+    """
+    try:
+        rendered_html = _worker_state["template"].render(**row)
+    except Exception as e:
+        raise PackageError(f"Błąd renderowania (pakiet {package_identifier}): {e}") from e
+
+    try:
+        write_template_assets(_worker_state["assets"], _worker_state["template_folder"], package_folder)
+    except Exception as e:
+        raise PackageError(f"Błąd kopiowania zasobów szablonu dla paczki {package_identifier}: {e}") from e
+
+    output_html_path = os.path.join(package_folder, "index.html")
+    try:
+        with open(output_html_path, 'w', encoding='utf-8') as f:
+            f.write(rendered_html)
+    except Exception as e:
+        raise PackageError(f"Błąd zapisu HTML dla paczki {package_identifier}: {e}") from e
+
+    try:
+        return zip_package(_worker_state["base_zip"], package_identifier, rendered_html, image_paths)
+    except Exception as e:
+        raise PackageError(f"Błąd tworzenia archiwum ZIP dla paczki {package_identifier}: {e}") from e
+
+def build_packages(jobs):
+    """
+    Buduje kolejno paczki z listy jobs (krotki argumentów build_package). Służy do wierszy o tym samym
+    identyfikatorze, które zapisują ten sam folder i ZIP – jak wcześniej, ostatni wiersz nadpisuje poprzednie.
+    Zwraca listę par (nazwa pliku ZIP, komunikat błędu) w kolejności jobs; jeden z elementów pary to None.
+    """
+    results = []
+    for job in jobs:
+        try:
+            results.append((build_package(*job), None))
+        except PackageError as e:
+            results.append((None, str(e)))
+    return results